@@ -1,128 +1,346 @@
-import csv
+import argparse
+import hashlib
+import io
+import os
+import re
+import shutil
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pdfminer
 import pdfplumber
+import pypdfium2 as pdfium
+import pypdfium2.raw as pdfium_c
+
+# Left edges of the Model, Designator, Legacy and RECAT columns.
+# Based on diagnostic:
+# Manuf ends < 190 (Eurocopter 141)
+# Model starts > 190 (Super Puma 197), upper bound slightly relaxed
+# Designator starts > 300 (AS3B 304, AT8T > 300?)
+# Legacy starts > 370 (M 377)
+# RECAT starts > 420 (CAT-F 423)
+_BUCKET_BOUNDS = [190, 295, 370, 410]
+
+CSV_HEADER = [
+    "Manufacturer",
+    "Model",
+    "ICAO Type Designator",
+    "ICAO Legacy WTC",
+    "RECAT-EU WTC",
+]
+
+CACHE_DIR = Path.home() / ".cache" / "extract-recat-eu"
+
+_RECAT_SET = frozenset({"SPECIAL", "TBC", "NONE"})
+_LEGACY_SET = frozenset({"L", "M", "H", "J"})
+
+# Header/footer text that must never end up in the CSV
+INVALID_KEYWORDS = [
+    "EUROPEAN UNION", "SAFETY AGENCY", "PROPRIETARY",
+    "RESERVED", "ISO9001", "TE.GEN", "PAGE OF",
+    "DATA DESIGNATOR", "LEGACY WTC", "SIGNATURE",
+    "PREPARED", "REVIEWED", "STRATEGY", "PROGRAMME",
+    "MANUFACTURER"
+]
+_INVALID_RE = re.compile("|".join(re.escape(k) for k in INVALID_KEYWORDS))
+
+def _is_recat_upper(val):
+    return val.startswith("CAT-") or val in _RECAT_SET
+
+def _is_legacy_upper(val):
+    return val in _LEGACY_SET
+
+def pdfplumber_open(pdf_data):
+    return pdfplumber.open(io.BytesIO(pdf_data))
+
+def pdfplumber_words(pdf, page_index):
+    """Extract the words of one page with pdfplumber."""
+    page = pdf.pages[page_index]
+    # Pinned so a change in pdfplumber's defaults cannot add per-char work
+    # (text flow ordering, extra attributes) that the clustering never reads
+    words = page.extract_words(
+        x_tolerance=3,
+        y_tolerance=3,
+        keep_blank_chars=False,
+        use_text_flow=False,
+        horizontal_ltr=True,
+        vertical_ttb=True,
+        extra_attrs=[],
+    )
+    # The document stays open for the whole run, so drop this page's cached objects
+    page.close()
+    return words
+
+def pypdfium_words(pdf, page_index, x_tolerance=3, y_tolerance=3):
+    """Extract the words of one page with pypdfium2, grouping chars into pdfplumber-style word dicts."""
+    page = pdf.get_page(page_index)
+    textpage = page.get_textpage()
+    height = page.get_height()
+
+    words = []
+    current = None
+    prev_x0 = prev_x1 = prev_top = None
+    # Read each char by char index: get_text_range() output is not guaranteed
+    # to line up index-for-index with get_charbox()
+    for i in range(textpage.count_chars()):
+        code = pdfium_c.FPDFText_GetUnicode(textpage, i)
+        # pdfium stores the hyphen of a wrapped word as a control char
+        # (get_text_range() turns it into U+FFFE)
+        if code < 0x20 and pdfium_c.FPDFText_IsHyphen(textpage, i):
+            char = "-"
+        else:
+            char = chr(code)
+        if not code or char.isspace():
+            current = None
+            continue
+
+        # pdfium uses a bottom-left origin, pdfplumber's 'top' is from the top edge
+        left, _, right, top = textpage.get_charbox(i, loose=True)
+        top = height - top
+
+        # Same test as pdfplumber's char_begins_new_word: a char that jumps back
+        # left, leaves a gap after the previous char, or moves to another line
+        # (compared with the previous char, not the word) starts a new word
+        if (
+            current is not None
+            and left >= prev_x0
+            and left - prev_x1 <= x_tolerance
+            and abs(top - prev_top) <= y_tolerance
+        ):
+            current["text"] += char
+            current["x1"] = right
+            current["top"] = min(current["top"], top)
+        else:
+            current = {"text": char, "x0": left, "x1": right, "top": top}
+            words.append(current)
+        prev_x0, prev_x1, prev_top = left, right, top
+
+    textpage.close()
+    page.close()
+    return words
+
+# Backend name -> (open a document from PDF bytes, extract the words of one page)
+BACKENDS = {
+    "pypdfium": (pdfium.PdfDocument, pypdfium_words),
+    "pdfplumber": (pdfplumber_open, pdfplumber_words),
+}
+
+def page_count(pdf_data):
+    pdf = pdfium.PdfDocument(pdf_data)
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+# Document opened once per worker process by _init_worker
+_worker_pdf = None
+_worker_backend = None
+
+def _init_worker(pdf_data, backend):
+    global _worker_pdf, _worker_backend
+    _worker_pdf = BACKENDS[backend][0](pdf_data)
+    _worker_backend = backend
+
+def _process_worker_page(page_index):
+    return process_page(_worker_pdf, page_index, _worker_backend)
+
+def cluster_rows(tops, x0s, y_tolerance=3):
+    """Yield the word indices of each visual line, left to right.
+
+    Words are swept in (top, x0) order and a new line starts once a word
+    sits more than y_tolerance below the first word of the current line.
+    """
+    order = sorted(range(len(tops)), key=lambda i: (tops[i], x0s[i]))
+
+    cur_top = None
+    cur_row = []
+    for i in order:
+        if cur_row and tops[i] - cur_top > y_tolerance:
+            cur_row.sort(key=x0s.__getitem__)
+            yield cur_row
+            cur_row = []
+        if not cur_row:
+            cur_top = tops[i]
+        cur_row.append(i)
+
+    if cur_row:
+        cur_row.sort(key=x0s.__getitem__)
+        yield cur_row
+
+def process_page(pdf, page_index, backend="pypdfium"):
+    """Parse a single page of an open document into aircraft rows."""
+    page_rows = []
+
+    # 1. Extract words with coordinates
+    words = BACKENDS[backend][1](pdf, page_index)
+    # Only text, x0 and top are used; keep them as parallel lists rather than a dict per word
+    texts = [w["text"] for w in words]
+    tops = [w["top"] for w in words]
+    x0s = [w["x0"] for w in words]
+    del words
+
+    # 2. Cluster words into rows based on 'top' (Y-coordinate)
+    for row in cluster_rows(tops, x0s):
+        # 3. Absolute Column Buckets (see _BUCKET_BOUNDS)
+        cols = [[], [], [], [], []]
+        for i in row:
+            cols[bisect_right(_BUCKET_BOUNDS, x0s[i])].append(texts[i])
+
+        # Join cols
+        manufacturer, model, designator, legacy_val, recat_val = (" ".join(c) for c in cols)
+        
+        # Valid Row Filter
+        # Cheapest and most selective checks first; every filter must pass,
+        # so the order does not change which rows are kept.
+
+        # We need reasonably populated rows.
+        # Must have Manufacturer, Model, Designator.
+        if not manufacturer or not model or not designator:
+            continue
+        
+        # Strict Data Validation:
+        # Real aircraft rows MUST have a valid RECAT or Legacy WTC.
+        # Garbage rows (like introductory text) will have random words like "Wake" or "Turbulence".
+        # Joined words never carry surrounding whitespace, so upper-casing
+        # once here is all the predicates and the keyword scan need.
+        legacy_upper = legacy_val.upper()
+        recat_upper = recat_val.upper()
+        if not (_is_recat_upper(recat_upper) or _is_legacy_upper(legacy_upper)):
+            continue
+
+        # Check for header/footer keywords in full string
+        row_str = f"{manufacturer} {model} {designator}".upper() + f" {legacy_upper} {recat_upper}"
+        if _INVALID_RE.search(row_str):
+            continue
+
+        page_rows.append([manufacturer, model, designator, legacy_val, recat_val])
+
+    return page_rows
+
+def _quote(cell):
+    # Same quoting as csv.QUOTE_MINIMAL; only the odd Manufacturer/Model has a comma
+    if "," in cell or '"' in cell or "\n" in cell or "\r" in cell:
+        return '"' + cell.replace('"', '""') + '"'
+    return cell
+
+def _fast_write_rows(f, rows):
+    """Write rows to a binary file exactly as csv.writer would, in one encode per batch."""
+    if rows:
+        f.write(("\r\n".join(",".join(_quote(c) for c in r) for r in rows) + "\r\n").encode("utf-8"))
+
+def _cache_path(pdf_path, backend):
+    """Cache file for this PDF, backend and version of the extractor."""
+    h = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        h.update(hashlib.file_digest(f, "sha256").digest())
+    # Changes to the parser or to the extraction libraries (e.g. after
+    # `uv lock --upgrade`) must not be answered from a stale cache
+    with open(__file__, "rb") as f:
+        h.update(hashlib.file_digest(f, "sha256").digest())
+    versions = (
+        f"{backend} pdfium={pdfium.PDFIUM_INFO} pypdfium2={pdfium.PYPDFIUM_INFO}"
+        f" pdfplumber={pdfplumber.__version__} pdfminer={pdfminer.__version__}"
+    )
+    h.update(versions.encode())
+    return CACHE_DIR / f"{h.hexdigest()[:16]}.csv"
+
+def _atomic_copy(src, dst):
+    """Copy src to dst via a temporary file, so dst is never left half-written."""
+    tmp_path = f"{dst}.{os.getpid()}.tmp"
+    try:
+        shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def pdf_to_csv(pdf_path, csv_path, backend="pypdfium", workers=None, use_cache=True):
+    cache_path = _cache_path(pdf_path, backend) if use_cache else None
+    if cache_path is not None and cache_path.exists():
+        _atomic_copy(cache_path, csv_path)
+        print(f"Reused cached conversion of {pdf_path} for {csv_path}")
+        return
+
+    # Read the PDF once; every worker opens its own document from these bytes
+    # instead of re-reading the file for each page
+    with open(pdf_path, "rb") as f:
+        pdf_data = f.read()
+
+    num_pages = page_count(pdf_data)
+    print(f"Processing {num_pages} pages...")
+
+    count = 0
+    seen: set[tuple[str, ...]] = set()
+    # Stream into a temporary file next to csv_path and only swap it in once
+    # every page has parsed, so a failed or interrupted run leaves the
+    # existing CSV untouched
+    tmp_path = f"{csv_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb", buffering=1 << 20) as f:
+            _fast_write_rows(f, [CSV_HEADER])
+
+            # Pages are independent; map() keeps them in order so the CSV is deterministic.
+            # Rows are written as each page comes back instead of being collected first.
+            with ProcessPoolExecutor(
+                max_workers=workers or os.cpu_count(),
+                initializer=_init_worker,
+                initargs=(pdf_data, backend),
+            ) as executor:
+                for page_rows in executor.map(_process_worker_page, range(num_pages), chunksize=4):
+                    # Identical rows repeated across pages are written once; rows that
+                    # differ in any column (e.g. a revised WTC) are all kept
+                    new_rows = []
+                    for row in page_rows:
+                        key = tuple(row)
+                        if key in seen:
+                            continue
+                        seen.add(key)
+                        new_rows.append(row)
+
+                    _fast_write_rows(f, new_rows)
+                    count += len(new_rows)
+
+        os.replace(tmp_path, csv_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    if cache_path is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        _atomic_copy(csv_path, cache_path)
 
-def is_recat_value(val):
-    if not val:
-        return False
-    val = val.upper().strip()
-    if val.startswith("CAT-") or val in ["SPECIAL", "TBC", "NONE"]:
-        return True
-    return False
-
-def is_legacy_value(val):
-    if not val:
-        return False
-    val = val.upper().strip()
-    if val in ["L", "M", "H", "J"]:
-        return True
-    return False
-
-def pdf_to_csv(pdf_path, csv_path):
-    with pdfplumber.open(pdf_path) as pdf:
-        all_rows = []
-        print(f"Processing {len(pdf.pages)} pages...")
-
-        for page in pdf.pages:
-            # 1. Extract words with coordinates
-            words = page.extract_words(x_tolerance=3, y_tolerance=3)
-            
-            # 2. Cluster words into rows based on 'top' (Y-coordinate)
-            rows = {}
-            for w in words:
-                y_bin = round(w['top'] / 3) * 3
-                if y_bin not in rows:
-                    rows[y_bin] = []
-                rows[y_bin].append(w)
-            
-            sorted_y = sorted(rows.keys())
-            for y in sorted_y:
-                row_words = sorted(rows[y], key=lambda x: x['x0'])
-                
-                # 3. Absolute Column Buckets
-                # Based on diagnostic:
-                # Manuf ends < 190 (Eurocopter 141)
-                # Model starts > 190 (Super Puma 197)
-                # Designator starts > 300 (AS3B 304, AT8T > 300?)
-                # Legacy starts > 370 (M 377)
-                # RECAT starts > 420 (CAT-F 423)
-                
-                manuf_words = []
-                model_words = []
-                desig_words = []
-                legacy_words = []
-                recat_words = []
-                
-                for w in row_words:
-                    x0 = w['x0']
-                    text = w['text']
-                    
-                    if x0 < 190:
-                        manuf_words.append(text)
-                    elif 190 <= x0 < 295:  # Slightly relaxed upper bound for Model
-                        model_words.append(text)
-                    elif 295 <= x0 < 370:  # Designator usually starts ~304
-                        desig_words.append(text)
-                    elif 370 <= x0 < 410:  # Legacy starts ~377
-                        legacy_words.append(text)
-                    elif x0 >= 410:        # RECAT starts ~423
-                        recat_words.append(text)
-                        
-                # Join cols
-                manufacturer = " ".join(manuf_words)
-                model = " ".join(model_words)
-                designator = " ".join(desig_words)
-                legacy_val = " ".join(legacy_words)
-                recat_val = " ".join(recat_words)
-                
-                # Valid Row Filter
-                # Check for header/footer keywords in full string
-                row_str = f"{manufacturer} {model} {designator} {legacy_val} {recat_val}".upper()
-                
-                invalid_keywords = [
-                    "EUROPEAN UNION", "SAFETY AGENCY", "PROPRIETARY", 
-                    "RESERVED", "ISO9001", "TE.GEN", "PAGE OF", 
-                    "DATA DESIGNATOR", "LEGACY WTC", "SIGNATURE",
-                    "PREPARED", "REVIEWED", "STRATEGY", "PROGRAMME",
-                    "MANUFACTURER"
-                ]
-                if any(k in row_str for k in invalid_keywords):
-                    continue
-                
-                # We need reasonably populated rows.
-                # Must have Manufacturer, Model, Designator.
-                if not manufacturer or not model or not designator:
-                    continue
-                
-                # Strict Data Validation:
-                # Real aircraft rows MUST have a valid RECAT or Legacy WTC.
-                # Garbage rows (like introductory text) will have random words like "Wake" or "Turbulence".
-                if not (is_recat_value(recat_val) or is_legacy_value(legacy_val)):
-                    continue
-
-                all_rows.append([manufacturer, model, designator, legacy_val, recat_val])
-
-        # Write to CSV
-        with open(csv_path, "w", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f)
-            writer.writerow(
-                [
-                    "Manufacturer",
-                    "Model",
-                    "ICAO Type Designator",
-                    "ICAO Legacy WTC",
-                    "RECAT-EU WTC",
-                ]
-            )
-            writer.writerows(all_rows)
-
-        print(f"Successfully converted {len(all_rows)} aircraft entries to {csv_path}")
+    print(f"Successfully converted {count} aircraft entries to {csv_path}")
 
 if __name__ == "__main__":
-    import sys
-    input_pdf = "recat-eu.pdf"
-    output_csv = "recat_eu_aircraft.csv"
-    if len(sys.argv) > 2:
-        input_pdf = sys.argv[1]
-    if len(sys.argv) > 3:
-        output_csv = sys.argv[2]
-    pdf_to_csv(input_pdf, output_csv)
+    parser = argparse.ArgumentParser(description="Convert the EASA RECAT-EU PDF to CSV.")
+    parser.add_argument("input_pdf", nargs="?", default="recat-eu.pdf")
+    parser.add_argument("output_csv", nargs="?", default="recat_eu_aircraft.csv")
+    parser.add_argument(
+        "--backend",
+        choices=sorted(BACKENDS),
+        default="pypdfium",
+        help="PDF text extraction backend (pdfplumber is slower but kept as a fallback)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (defaults to the CPU count)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="use_cache",
+        action="store_false",
+        help=f"Always re-parse the PDF instead of reusing a previous result from {CACHE_DIR}",
+    )
+    args = parser.parse_args()
+    pdf_to_csv(
+        args.input_pdf,
+        args.output_csv,
+        backend=args.backend,
+        workers=args.workers,
+        use_cache=args.use_cache,
+    )